@@ -8,13 +8,25 @@ import os
 import cv2
 import numpy as np
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
 import pickle
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont
 import json
 import sys
+import argparse
 import logging
 import contextlib
 import io
+import onnxruntime
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
 
 # ----------------- Logging Setup -----------------
 logger = logging.getLogger(__name__)
@@ -30,50 +42,259 @@ logger.addHandler(stderr_handler)
 TEST_FOLDER = "test-images"
 OUTPUT_FOLDER = "output"
 EMBEDDINGS_FILE = "face_embeddings.pkl"
+GALLERY_MATRIX_FILE = "face_embeddings.npy"
+GALLERY_NAMES_FILE = "face_names.json"
+INDEX_FILE = "face_embeddings.faiss"
+
+# ----------------- Gallery Search -----------------
+SEARCH_K = 5              # candidate students returned per face
+SQ8_MIN_GALLERY = 2000    # store vectors as 8-bit scalar-quantized codes above this size
+IVF_MIN_GALLERY = 10000   # switch from exact to inverted-file search above this size
+IVF_NPROBE = 8
+
+# ----------------- Decoding -----------------
+# JPEGs whose shorter side exceeds the threshold are halved by libjpeg while decoding. ArcFace
+# aligns from these pixels too, so if any face comes out smaller than REDUCED_MIN_FACE (or none
+# is found) the image is decoded again at full resolution
+REDUCED_DECODE = (
+    (1200, cv2.IMREAD_REDUCED_COLOR_2, 2),
+)
+REDUCED_MIN_FACE = 40   # px, shorter bbox side in the reduced image
+
+# ----------------- Detection Cache -----------------
+DET_CACHE_SIZE = 64
+DET_CACHE_MAX_DIFF = 3.0  # mean absolute difference of 32x32 thumbnails, in [0, 255]
+_det_cache = []           # (image shape, thumbnail, detected faces, found on enhanced image), most recently used last
+
+# ----------------- Worker Pool -----------------
+MAX_WORKERS = 8   # each worker loads its own detection + recognition sessions (hundreds of MB)
+
+# ----------------- Model -----------------
+DEVICE = os.environ.get("FACEFLOW_DEVICE", "auto").lower()   # auto | cpu | cuda | tensorrt | openvino
+DEVICE_PROVIDERS = {
+    "tensorrt": [
+        ('TensorrtExecutionProvider', {
+            'trt_fp16_enable': True,
+            'trt_engine_cache_enable': True,   # each run is a fresh process; don't rebuild engines
+            'trt_engine_cache_path': 'trt_cache',
+        }),
+        'CUDAExecutionProvider',
+        'CPUExecutionProvider',
+    ],
+    "cuda": ['CUDAExecutionProvider', 'CPUExecutionProvider'],
+    "openvino": ['OpenVINOExecutionProvider', 'CPUExecutionProvider'],
+    "cpu": ['CPUExecutionProvider'],
+}
+GPU_PROVIDERS = ('TensorrtExecutionProvider', 'CUDAExecutionProvider')
+MODEL_MODULES = ['detection', 'recognition']   # gender/age/landmark models are never used here
+DET_SIZE = 640
+SMALL_DET_SIZE = (320, 320)   # detector input for images whose longer side is below SMALL_IMAGE_SIDE
+SMALL_IMAGE_SIDE = 600
+
+# ----------------- Enhancement -----------------
+CONFIDENCE_THRESHOLD = 0.45
+ENHANCE_FACTORS = (1.2, 1.5, 1.3)   # brightness, contrast, sharpness
+# ImageEnhance.Sharpness extrapolates away from PIL's SMOOTH-filtered image
+_SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+_IDENTITY_KERNEL = np.zeros((3, 3), dtype=np.float32)
+_IDENTITY_KERNEL[1, 1] = 1.0
 
 # ----------------- Helper Functions -----------------
-def enhance_image(img):
+@lru_cache(maxsize=None)
+def sharpen_kernel(sharpness):
+    return sharpness * _IDENTITY_KERNEL - (sharpness - 1.0) * _SMOOTH_KERNEL
+
+def enhance_image(img, enhance_factors=ENHANCE_FACTORS):
+    """Brightness, contrast and sharpness boost matching the PIL ImageEnhance chain, in two OpenCV passes"""
     try:
-        pil = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        pil = ImageEnhance.Brightness(pil).enhance(1.2)
-        pil = ImageEnhance.Contrast(pil).enhance(1.5)
-        pil = ImageEnhance.Sharpness(pil).enhance(1.3)
-        return cv2.cvtColor(np.array(pil), cv2.COLOR_RGB2BGR)
+        brightness, contrast, sharpness = enhance_factors
+        # Brightness and contrast are both per-value maps, so fold them into one lookup table;
+        # contrast pivots around the mean gray level of the brightened (and clipped) image, as
+        # in PIL, taken from per-channel histograms mapped through the brightness levels.
+        # PIL truncates both per-value maps and rounds only the mean, so the same is done here
+        levels = np.clip(np.arange(256, dtype=np.float32) * brightness, 0, 255).astype(np.uint8)
+        levels = levels.astype(np.float32)
+        b, g, r = (float(np.bincount(img[..., c].ravel(), minlength=256) @ levels) for c in range(3))
+        mean_gray = int((0.114 * b + 0.587 * g + 0.299 * r) / (img.shape[0] * img.shape[1]) + 0.5)
+        lut = np.clip(mean_gray + contrast * (levels - mean_gray), 0, 255).astype(np.uint8)
+        return cv2.filter2D(cv2.LUT(img, lut), -1, sharpen_kernel(sharpness))
     except Exception as e:
         logger.warning(f"Image enhancement failed: {e}")
         return img
 
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def stack_embeddings(faces):
+    """Stack face embeddings into a unit-row (F, 512) matrix plus a validity mask.
+
+    normed_embedding is already unit length, so cosine similarity is a plain dot product.
+    Rows are still renormalized in one batched pass (instead of per face) so no embedding
+    can skew the threshold; degenerate (NaN/inf/zero) rows are masked out.
+    """
+    embs = np.stack([f.normed_embedding for f in faces]).astype(np.float32, copy=False)
+    valid = np.isfinite(embs).all(axis=1)
+    embs[~valid] = 0.0
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    valid &= norms[:, 0] > 0
+    np.divide(embs, norms, out=embs, where=norms > 0)
+    return embs, valid
+
+def build_index(known_mat):
+    """Build a FAISS inner-product index over the row-normalized gallery.
+
+    Large galleries are stored as 8-bit codes (4x less memory traffic per scan); the
+    quantization error on unit vectors is far below the gap around the match threshold.
+    """
+    dim = known_mat.shape[1]
+    if len(known_mat) > IVF_MIN_GALLERY:
+        index = faiss.index_factory(dim, "IVF256,SQ8", faiss.METRIC_INNER_PRODUCT)
+    elif len(known_mat) > SQ8_MIN_GALLERY:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    if not index.is_trained:
+        index.train(known_mat)
+    index.add(known_mat)
+    return index
+
+def load_index(known_mat):
+    """Restore the persisted index if it matches the gallery, otherwise rebuild and persist it"""
+    if faiss is None:
+        return None
+    index = None
+    if os.path.exists(INDEX_FILE) and os.path.getmtime(INDEX_FILE) >= os.path.getmtime(EMBEDDINGS_FILE):
+        try:
+            index = faiss.read_index(INDEX_FILE)
+            if index.ntotal != len(known_mat) or index.d != known_mat.shape[1]:
+                index = None
+        except Exception as e:
+            logger.warning(f"Failed to read FAISS index, rebuilding: {e}")
+            index = None
+    if index is None:
+        index = build_index(known_mat)
+        # Write beside the target and rename over it, so a concurrent run never reads a partial file
+        tmp_path = f"{INDEX_FILE}.{os.getpid()}.tmp"
+        try:
+            faiss.write_index(index, tmp_path)
+            os.replace(tmp_path, INDEX_FILE)
+        except Exception as e:
+            logger.warning(f"Failed to persist FAISS index: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+    return index
+
+def load_gallery_arrays():
+    """Memory-map the contiguous gallery matrix written by training, if it is current
 
-def save_annotated_image(pil_image, faces, known_faces, image_name, confidence_threshold):
+    Training writes it as float16; it is returned as float32.
+    """
+    if not (os.path.exists(GALLERY_MATRIX_FILE) and os.path.exists(GALLERY_NAMES_FILE)):
+        return None
+    if os.path.getmtime(GALLERY_MATRIX_FILE) < os.path.getmtime(EMBEDDINGS_FILE):
+        return None
     try:
+        known_mat = np.load(GALLERY_MATRIX_FILE, mmap_mode='r')
+        with open(GALLERY_NAMES_FILE) as f:
+            known_names = json.load(f)
+    except Exception as e:
+        logger.warning(f"Failed to load gallery arrays, falling back to pickle: {e}")
+        return None
+    if len(known_names) != len(known_mat):
+        return None
+    if known_mat.dtype != np.float32:
+        # Stored as float16; upcast once so similarity matmuls stay on the float32 BLAS path
+        known_mat = known_mat.astype(np.float32)
+    return known_names, known_mat
+
+def load_gallery():
+    """Load the trained embeddings as (names, row-normalized (N, 512) matrix, FAISS index or None)"""
+    arrays = load_gallery_arrays()
+    if arrays is not None:
+        known_names, known_mat = arrays
+    else:
+        with open(EMBEDDINGS_FILE, "rb") as f:
+            known_faces = pickle.load(f)
+        known_names = list(known_faces)
+        known_mat = np.zeros((0, 512), dtype=np.float32)
+        if known_faces:
+            known_mat = np.stack([known_faces[n] for n in known_names]).astype(np.float32)
+            known_mat /= np.linalg.norm(known_mat, axis=1, keepdims=True)
+    if not known_names:
+        return None
+    return known_names, known_mat, load_index(known_mat)
+
+def search_gallery(embs, gallery):
+    """Return (similarities, gallery indices) of the candidate students for each face"""
+    _, known_mat, index = gallery
+    if index is None:
+        sims = embs @ known_mat.T
+        return sims, np.broadcast_to(np.arange(len(known_mat)), sims.shape)
+    return index.search(embs, min(SEARCH_K, index.ntotal))
+
+def match_faces(embs, gallery, confidence_threshold):
+    """Greedily assign faces to gallery rows, highest similarity first.
+
+    Returns one (gallery_index, similarity) pair per face; unmatched faces get (-1, 0.0).
+    """
+    n_faces, n_known = len(embs), len(gallery[0])
+    matches = [(-1, 0.0)] * n_faces
+    if n_faces == 0 or n_known == 0:
+        return matches
+    sims, ids = search_gallery(embs, gallery)
+    n_candidates = sims.shape[1]
+    sims, ids = sims.ravel(), ids.ravel()
+    # Threshold and sort in numpy, then walk plain Python ints rather than numpy scalars
+    above = np.flatnonzero(sims > confidence_threshold)
+    order = above[np.argsort(-sims[above])]
+    face_used, name_used = set(), set()
+    remaining = min(n_faces, n_known)
+    for face_idx, name_idx, sim in zip((order // n_candidates).tolist(), ids[order].tolist(), sims[order].tolist()):
+        if name_idx < 0 or face_idx in face_used or name_idx in name_used:
+            continue
+        face_used.add(face_idx)
+        name_used.add(name_idx)
+        matches[face_idx] = (name_idx, sim)
+        remaining -= 1
+        if remaining == 0:
+            break
+    return matches
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    """Resolve the label font once per process instead of on every annotated image"""
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+def save_annotated_image(img, faces, face_labels, image_name):
+    """Draw each face with its (student name or None, similarity) label from recognition"""
+    try:
+        # Let PIL's raw decoder swap BGR->RGB while copying, instead of cvtColor plus a second copy
+        pil_image = Image.frombuffer("RGB", (img.shape[1], img.shape[0]), np.ascontiguousarray(img), "raw", "BGR", 0, 1)
         draw = ImageDraw.Draw(pil_image)
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except:
-            font = ImageFont.load_default()
-        recognized = set()
-        for idx, face in enumerate(faces):
+        font = load_font(20)
+        for face, (name, sim) in zip(faces, face_labels):
             bbox = face.bbox.astype(int)
-            embedding = face.normed_embedding
-            if np.linalg.norm(embedding) > 0:
-                embedding = embedding / np.linalg.norm(embedding)
             best_match, best_sim = "Unknown", 0.0
-            for name, known_emb in known_faces.items():
-                try:
-                    sim = cosine_similarity(embedding, known_emb)
-                    if sim > best_sim and sim > confidence_threshold and name not in recognized:
-                        best_match, best_sim = name.title(), sim
-                except: 
-                    continue
-            if best_match != "Unknown":
-                recognized.add(best_match.lower())
+            if name:
+                best_match, best_sim = name.title(), sim
             color = "lime" if best_match != "Unknown" else "red"
             text_color = "black" if best_match != "Unknown" else "white"
             draw.rectangle([bbox[0]-1, bbox[1]-1, bbox[2]+1, bbox[3]+1], outline=color, width=3)
             draw.text((bbox[0], max(0, bbox[1]-20)), f"{best_match} {best_sim:.2f}", fill=text_color, font=font)
-        pil_image.save(os.path.join(OUTPUT_FOLDER, f"annotated_{image_name}"), quality=95)
+        output_path = os.path.join(OUTPUT_FOLDER, f"annotated_{image_name}")
+        # Encoding releases the GIL, so overlap it with the next image's inference
+        if _io_pool is not None:
+            _io_pool.submit(write_image, pil_image, output_path)
+        else:
+            write_image(pil_image, output_path)
+    except Exception as e:
+        logger.error(f"Failed to save annotated image: {e}")
+
+def write_image(pil_image, output_path):
+    try:
+        pil_image.save(output_path, quality=85, optimize=False, progressive=False)
     except Exception as e:
         logger.error(f"Failed to save annotated image: {e}")
 
@@ -86,46 +307,103 @@ def safe_get(app, img):
         sys.stderr.write(out + "\n")
     return faces
 
-def process_image(image_path, known_faces, app, idx, confidence_threshold=0.45):
+def detect_faces(app, img):
+    # Detector cost grows with det_size^2; small images gain nothing from the full-size input
+    app.det_model.input_size = SMALL_DET_SIZE if max(img.shape[:2]) < SMALL_IMAGE_SIDE else app.det_size
+    try:
+        return safe_get(app, img) or []
+    except Exception as e:
+        logger.debug(f"Face detection error: {e}")
+        return []
+
+def read_image(image_path, reduce=True):
+    """Decode an image, downscaling oversized JPEGs in the DCT domain unless reduce is False.
+
+    Returns (image, scale), where scale maps decoded pixel coordinates back to the original.
+    """
+    flag, scale = cv2.IMREAD_COLOR, 1
+    if not reduce:
+        return cv2.imread(image_path, flag), scale
+    try:
+        with Image.open(image_path) as probe:   # parses the header only
+            if probe.format == "JPEG":
+                for min_side, reduced_flag, factor in REDUCED_DECODE:
+                    if min(probe.size) > min_side:
+                        flag, scale = reduced_flag, factor
+                        break
+    except Exception as e:
+        logger.debug(f"Could not probe image size: {e}")
+    return cv2.imread(image_path, flag), scale
+
+def embed_detections(app, img, detections):
+    """Embed previously detected faces (bbox/kps) from img's own pixels, skipping the detector"""
+    if not detections:
+        return []
+    rec_model = app.models['recognition']
+    crops = [face_align.norm_crop(img, landmark=d.kps, image_size=rec_model.input_size[0]) for d in detections]
+    faces = []
+    for d, feat in zip(detections, rec_model.get_feat(crops)):
+        face = Face(bbox=d.bbox, kps=d.kps, det_score=d.det_score)
+        face.embedding = feat.flatten()
+        faces.append(face)
+    return faces
+
+def find_faces(app, img, enhance_factors=ENHANCE_FACTORS):
+    """Detect faces, reusing the face locations of a near-identical recent image (e.g. burst shots).
+
+    Only detector output is shared: identities are always embedded from this image's pixels,
+    since two similar-looking shots can still contain different students.
+    """
+    thumb = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    for i, (shape, cached_thumb, detections, enhanced) in enumerate(_det_cache):
+        if shape == img.shape and np.abs(thumb - cached_thumb).mean() < DET_CACHE_MAX_DIFF:
+            _det_cache.append(_det_cache.pop(i))
+            logger.debug("Detection cache hit")
+            return embed_detections(app, enhance_image(img, enhance_factors) if enhanced else img, detections)
+    logger.debug("Detection cache miss")
+    # Detect on the original; the enhanced image is only a fallback when nothing is found
+    faces, enhanced = detect_faces(app, img), False
+    if not faces:
+        faces, enhanced = detect_faces(app, enhance_image(img, enhance_factors)), True
+    detections = [Face(bbox=f.bbox, kps=f.kps, det_score=f.det_score) for f in faces]
+    _det_cache.append((img.shape, thumb, detections, enhanced))
+    if len(_det_cache) > DET_CACHE_SIZE:
+        _det_cache.pop(0)
+    return faces
+
+def process_image(image_path, gallery, app, idx, confidence_threshold=CONFIDENCE_THRESHOLD,
+                  enhance_factors=ENHANCE_FACTORS):
     detections = []
     try:
-        img = cv2.imread(image_path)
+        img, scale = read_image(image_path)
         if img is None or img.shape[0] == 0 or img.shape[1] == 0:
             logger.warning(f"Invalid image: {image_path}")
             return detections
-        pil = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        faces = []
-        for variant in [img, enhance_image(img)]:
-            try:
-                detected = safe_get(app, variant)
-                if detected:
-                    faces.extend(detected)
-            except Exception as e:
-                logger.debug(f"Face detection error: {e}")
-        # Remove overlapping faces
-        unique_faces = []
-        for face in faces:
-            bbox = face.bbox
-            if not any(
-                max(0, min(bbox[2], uf.bbox[2])-max(bbox[0], uf.bbox[0])) *
-                max(0, min(bbox[3], uf.bbox[3])-max(bbox[1], uf.bbox[1])) / 
-                min((bbox[2]-bbox[0])*(bbox[3]-bbox[1]), (uf.bbox[2]-uf.bbox[0])*(uf.bbox[3]-uf.bbox[1])) > 0.7
-                for uf in unique_faces
-            ):
-                unique_faces.append(face)
-        recognized = set()
-        for i, face in enumerate(unique_faces):
-            bbox = face.bbox.astype(int).tolist()
-            emb = face.normed_embedding
-            if np.linalg.norm(emb) > 0:
-                emb = emb / np.linalg.norm(emb)
-            else:
+        faces = find_faces(app, img, enhance_factors)
+        if scale > 1 and (not faces or min(
+                min(f.bbox[2] - f.bbox[0], f.bbox[3] - f.bbox[1]) for f in faces) < REDUCED_MIN_FACE):
+            # Too small to embed well (or missed) at reduced size: recognize from full-resolution pixels
+            full_img, full_scale = read_image(image_path, reduce=False)
+            if full_img is not None:
+                img, scale = full_img, full_scale
+                faces = find_faces(app, img, enhance_factors)
+        known_names = gallery[0]
+        face_labels, valid = [], []
+        if faces:
+            embs, valid = stack_embeddings(faces)
+            # Only valid rows take part in matching, so a degenerate embedding can never claim
+            # a student (e.g. with a non-positive threshold) and block a real face from it
+            valid_idx = np.flatnonzero(valid)
+            face_labels = [(None, 0.0)] * len(faces)
+            matches = match_faces(embs[valid_idx], gallery, confidence_threshold)
+            for i, (name_idx, sim) in zip(valid_idx.tolist(), matches):
+                face_labels[i] = (known_names[name_idx] if name_idx >= 0 else None, sim)
+        for i, face in enumerate(faces):
+            if not valid[i]:
                 continue
-            best_match, best_sim = None, 0.0
-            for name, known_emb in known_faces.items():
-                sim = cosine_similarity(emb, known_emb)
-                if sim > best_sim and sim > confidence_threshold and name not in recognized:
-                    best_match, best_sim = name, sim
+            # Report boxes in original-image coordinates even when decoded at reduced size
+            bbox = (face.bbox * scale).astype(int).tolist()
+            best_match, best_sim = face_labels[i]
             detections.append({
                 "imageIndex": idx,
                 "faceIndex": i,
@@ -134,15 +412,92 @@ def process_image(image_path, known_faces, app, idx, confidence_threshold=0.45):
                 "studentId": best_match if best_match else None
             })
             if best_match:
-                recognized.add(best_match)
                 logger.info(f"✓ Recognized: {best_match} ({best_sim:.3f})")
-        save_annotated_image(pil, unique_faces, known_faces, os.path.basename(image_path), confidence_threshold)
+        save_annotated_image(img, faces, face_labels, os.path.basename(image_path))
     except Exception as e:
         logger.error(f"Error processing {image_path}: {e}")
     return detections
 
+_app = None
+_gallery = None
+_io_pool = None
+_options = None
+
+# select_providers/create_app are kept identical in recognize and train, which are deployed
+# as standalone scripts
+def select_providers():
+    """Execution providers for FACEFLOW_DEVICE, keeping only those this onnxruntime build has.
+
+    'auto' (the default) means CUDA on GPU builds of onnxruntime and plain CPU otherwise.
+    """
+    device = DEVICE
+    if device == "auto":
+        device = "cuda" if onnxruntime.get_device() == "GPU" else "cpu"
+    available = set(onnxruntime.get_available_providers())
+    providers = [p for p in DEVICE_PROVIDERS.get(device, DEVICE_PROVIDERS["cpu"])
+                 if (p[0] if isinstance(p, tuple) else p) in available]
+    return providers or ['CPUExecutionProvider']
+
+def create_app(det_size=DET_SIZE, intra_op_threads=1):
+    """Load detection + recognition on the selected providers with intra_op_threads ORT threads"""
+    providers = select_providers()
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_threads
+    with contextlib.redirect_stdout(sys.stderr):
+        # Load on CPU first: FaceAnalysis does not forward session options, so each session is
+        # rebuilt with them, and building GPU sessions twice would double engine setup
+        app = FaceAnalysis(name='buffalo_l', allowed_modules=MODEL_MODULES, providers=['CPUExecutionProvider'])
+        for model in app.models.values():
+            model.session = onnxruntime.InferenceSession(
+                model.model_file, sess_options=sess_options, providers=providers)
+        # ctx_id stays 0: a negative ctx_id makes InsightFace force the sessions back onto the CPU provider
+        app.prepare(ctx_id=0, det_size=(det_size, det_size))
+        if providers[0] != 'CPUExecutionProvider':
+            # Pay CUDA/TensorRT initialization before the first real image
+            app.get(np.zeros((det_size, det_size, 3), dtype=np.uint8))
+    return app
+
+def available_cpus():
+    """CPUs this process may run on, honouring affinity/cgroup cpusets unlike os.cpu_count()"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:   # not available on Windows/macOS
+        return os.cpu_count() or 1
+
+def _worker_init(options):
+    global _app, _gallery, _io_pool, _options
+    _options = options
+    # Single-threaded sessions so parallel workers don't oversubscribe the cores
+    _app = create_app(options.det_size, intra_op_threads=1)
+    _gallery = load_gallery()
+    _io_pool = ThreadPoolExecutor(max_workers=2)
+    # Pool workers exit without atexit hooks; a finalizer drains pending encodes first
+    multiprocessing.util.Finalize(_io_pool, _io_pool.shutdown, kwargs={"wait": True}, exitpriority=10)
+
+def _session_provider():
+    """Provider the worker's detection session actually runs on"""
+    return _app.models['detection'].session.get_providers()[0]
+
+def _process_one(task):
+    idx, img_name = task
+    return process_image(os.path.join(TEST_FOLDER, img_name), _gallery, _app, idx,
+                         _options.confidence_threshold, tuple(_options.enhance_factors))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Recognize trained students in test-images/")
+    parser.add_argument("--confidence-threshold", type=float, default=CONFIDENCE_THRESHOLD,
+                        help="minimum cosine similarity for a match (default: %(default)s)")
+    parser.add_argument("--enhance-factors", type=float, nargs=3, default=list(ENHANCE_FACTORS),
+                        metavar=("BRIGHTNESS", "CONTRAST", "SHARPNESS"),
+                        help="enhancement applied when no face is found on the original (default: %(default)s)")
+    parser.add_argument("--det-size", type=int, default=DET_SIZE,
+                        help="detector input size for images of %d px and larger (default: %%(default)s)" % SMALL_IMAGE_SIDE)
+    return parser.parse_args()
+
 # ----------------- Main -----------------
 def main():
+    options = parse_args()
+    streaming = False
     try:
         os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
@@ -153,18 +508,13 @@ def main():
             }))
             sys.exit(1)
 
-        with open(EMBEDDINGS_FILE, "rb") as f:
-            known_faces = pickle.load(f)
-
-        if not known_faces:
+        # Loading here also builds and persists the FAISS index before the workers read it
+        if load_gallery() is None:
             print(json.dumps({
                 "error": "No trained faces found",
                 "totalFaces": 0, "recognizedStudents": [], "averageConfidence": 0.0, "detections": []
             }))
             sys.exit(1)
-        with contextlib.redirect_stdout(sys.stderr):
-            app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-            app.prepare(ctx_id=0, det_size=(640,640))
 
         if not os.path.exists(TEST_FOLDER):
             print(json.dumps({
@@ -181,30 +531,56 @@ def main():
             }))
             sys.exit(1)
 
-        all_detections, total_faces, recognized_students, confidences = [], 0, set(), []
+        # Detections are streamed out as they arrive; only running aggregates are kept.
+        # The whole object stays on one line, which is how the server finds it in stdout.
+        out = sys.stdout
+        total_faces, recognized_students, confidence_sum, recognized_faces = 0, set(), 0.0, 0
+        out.write('{"detections": [')
+        streaming = True
 
-        for idx, img_name in enumerate(sorted(image_files)):
-            dets = process_image(os.path.join(TEST_FOLDER, img_name), known_faces, app, idx)
-            all_detections.extend(dets)
-            for d in dets:
-                total_faces += 1
-                if d['studentId']:
-                    recognized_students.add(d['studentId'])
-                    confidences.append(d['confidence'])
+        # Images are independent, so fan them out over one model-loaded worker per usable core
+        workers = min(available_cpus(), MAX_WORKERS, len(image_files))
+        ex = None
+        if select_providers()[0] in GPU_PROVIDERS:
+            # ORT silently falls back to CPU (e.g. onnxruntime-gpu on a host without a GPU), so ask
+            # a loaded worker what its sessions really run on. On a GPU that one process keeps the
+            # device busy and more would only add CUDA contexts; otherwise use the full CPU pool
+            ex = ProcessPoolExecutor(max_workers=1, initializer=_worker_init, initargs=(options,))
+            if ex.submit(_session_provider).result() in GPU_PROVIDERS:
+                workers = 1
+            else:
+                ex.shutdown()
+                ex = None
+        if ex is None:
+            ex = ProcessPoolExecutor(max_workers=workers, initializer=_worker_init, initargs=(options,))
+        chunksize = max(1, min(4, len(image_files) // workers))
+        with ex:
+            for dets in ex.map(_process_one, enumerate(sorted(image_files)), chunksize=chunksize):
+                for d in dets:
+                    if total_faces:
+                        out.write(", ")
+                    json.dump(d, out)
+                    total_faces += 1
+                    if d['studentId']:
+                        recognized_students.add(d['studentId'])
+                        confidence_sum += d['confidence']
+                        recognized_faces += 1
 
-        avg_conf = float(np.mean(confidences)) if confidences else 0.0
-        result = {
+        avg_conf = confidence_sum / recognized_faces if recognized_faces else 0.0
+        summary = {
             "totalFaces": total_faces,
             "recognizedStudents": list(recognized_students),
             "averageConfidence": avg_conf,
-            "detections": all_detections,
             "processedImages": len(image_files)
         }
 
-        print(json.dumps(result))  # ✅ Only JSON to stdout
+        # Close the detections array and splice the summary fields into the same object
+        out.write("], " + json.dumps(summary)[1:] + "\n")  # ✅ Only JSON to stdout
 
     except Exception as e:
         logger.error(f"Recognition failed: {e}")
+        if streaming:
+            sys.stdout.write("\n")   # put the error object on its own line after the partial stream
         print(json.dumps({
             "error": str(e),
             "totalFaces": 0, "recognizedStudents": [], "averageConfidence": 0.0, "detections": []
@@ -1,22 +1,58 @@
 import os
 import cv2
 import numpy as np
-import imgaug.augmenters as iaa
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.manifold import TSNE
-from sklearn.preprocessing import StandardScaler
+from scipy.spatial.distance import pdist
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
 import pickle
 import sys
 import base64
-from PIL import Image
-import io
+import json
+import contextlib
+import onnxruntime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # Path Configuration
 DATASET_PATH = "dataset"
 OUTPUT_FILE = "face_embeddings.pkl"
+GALLERY_MATRIX_FILE = "face_embeddings.npy"
+GALLERY_NAMES_FILE = "face_names.json"
 VISUALIZATION_PATH = "training_visualization.png"
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+TSNE_PCA_COMPONENTS = 50   # dimensions kept by PCA before t-SNE
+EMBEDDING_DIM = 512
+EMBED_BATCH_SIZE = 64   # aligned crops per recognition call
+DIVERSITY_MIN_FACES = 5     # students with at least this many faces may skip augmentation...
+DIVERSITY_THRESHOLD = 0.4   # ...when 1 - mean pairwise cosine similarity of their photos exceeds this
+MIN_FACE_SIZE = 80      # faces whose bbox area is below MIN_FACE_SIZE^2 px are too small to train on
+AUG_MIN_NOISE_STD = 1.0   # sampled augmentation noise below this (grey levels) is skipped
+AUG_MIN_BLUR_SIGMA = 0.3  # sampled augmentation blur below this is skipped
+LOADER_CPU_SHARE = 4   # one decode thread running ahead of inference per this many usable CPUs
+
+# Model (FACEFLOW_DEVICE: see select_providers)
+DEVICE = os.environ.get("FACEFLOW_DEVICE", "auto").lower()   # auto | cpu | cuda | tensorrt | openvino
+DEVICE_PROVIDERS = {
+    "tensorrt": [
+        ('TensorrtExecutionProvider', {
+            'trt_fp16_enable': True,
+            'trt_engine_cache_enable': True,   # each run is a fresh process; don't rebuild engines
+            'trt_engine_cache_path': 'trt_cache',
+        }),
+        'CUDAExecutionProvider',
+        'CPUExecutionProvider',
+    ],
+    "cuda": ['CUDAExecutionProvider', 'CPUExecutionProvider'],
+    "openvino": ['OpenVINOExecutionProvider', 'CPUExecutionProvider'],
+    "cpu": ['CPUExecutionProvider'],
+}
+MODEL_MODULES = ['detection', 'recognition']
+DET_SIZE = 640
 
 def main():
     try:
@@ -27,108 +63,109 @@ def main():
 
         # Initialize InsightFace ArcFace model
         print("Initializing face recognition model...")
-        app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-        app.prepare(ctx_id=0, det_size=(640, 640))
+        # Training is a single process, so its sessions may use every core
+        app = create_app(intra_op_threads=available_cpus())
+        print(f"Using execution providers: {', '.join(select_providers())}")
 
         # Storage
-        embedding_vectors = []
-        labels = []
         face_dict = {}
         total_students = 0
         total_images_processed = 0
 
-        # Enhanced augmentation pipeline for better training
-        augmenter = iaa.Sequential([
-            iaa.Fliplr(0.5),  # Horizontal flip
-            iaa.Affine(rotate=(-15, 15)),  # Rotation
-            iaa.Multiply((0.8, 1.2)),  # Brightness
-            iaa.GammaContrast((0.7, 1.3)),  # Contrast
-            iaa.AdditiveGaussianNoise(scale=(0, 0.03*255)),  # Noise
-            iaa.GaussianBlur(sigma=(0, 1.0)),  # Slight blur
-        ])
-
         print("Processing student photos...")
 
         # Process each student folder
-        student_folders = [d for d in os.listdir(DATASET_PATH) 
-                          if os.path.isdir(os.path.join(DATASET_PATH, d))]
+        with os.scandir(DATASET_PATH) as entries:
+            student_folders = [e.name for e in entries if e.is_dir()]
         
         if not student_folders:
             print("Error: No student folders found in dataset")
             sys.exit(1)
 
+        # List every student's photos up front so decoding can run ahead across students
+        student_images = []
         for student_folder in sorted(student_folders):
             person_path = os.path.join(DATASET_PATH, student_folder)
+            with os.scandir(person_path) as entries:
+                image_files = [e.name for e in entries
+                               if e.is_file() and os.path.splitext(e.name)[1].lower() in IMAGE_SUFFIXES]
+            num_augmentations = min(3, max(1, 5 - len(image_files)))  # Adaptive augmentation (upper bound)
+            student_images.append((student_folder, person_path, image_files, num_augmentations))
+
+        # Decode on worker threads (OpenCV releases the GIL) while the main thread runs inference
+        tasks = [
+            os.path.join(person_path, image_name)
+            for _, person_path, image_files, _ in student_images
+            for image_name in image_files
+        ]
+        # The ORT sessions already use every core; decoding only needs to stay ahead of them,
+        # and the bounded prefetch leaves these threads idle once it has
+        loader_workers = max(1, available_cpus() // LOADER_CPU_SHARE)
+        executor = ThreadPoolExecutor(max_workers=loader_workers)
+        loaded_images = prefetch(executor, load_training_image, tasks, depth=2 * loader_workers)
+        rng = np.random.default_rng()
+        gpu_augmenter = build_gpu_augmenter()
+        if gpu_augmenter is not None:
+            print("Augmenting face crops on the GPU")
+
+        # Every sample lands in one preallocated matrix; student i owns rows offsets[i]:offsets[i+1]
+        # and sample_labels holds the matching index into student_labels
+        max_samples = sum(len(image_files) * (1 + num_augmentations)
+                          for _, _, image_files, num_augmentations in student_images)
+        all_emb = np.empty((max_samples, EMBEDDING_DIM), dtype=np.float32)
+        sample_labels = np.empty(max_samples, dtype=np.int32)
+        offsets = [0]
+        student_labels = []
+
+        for student_folder, person_path, image_files, num_augmentations in student_images:
             total_students += 1
-            person_embeddings = []
+            face_crops = []
             images_for_person = 0
 
             print(f"Processing student: {student_folder}")
-
-            # Get all image files in student folder
-            image_files = [f for f in os.listdir(person_path) 
-                          if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
             
             if not image_files:
                 print(f"  - No images found for {student_folder}")
                 continue
 
             for image_name in image_files:
-                image_path = os.path.join(person_path, image_name)
-                
+                img, error = next(loaded_images)
+                if img is None:
+                    print(f"  - {error or f'Skipping corrupted file: {image_name}'}")
+                    continue
+
                 try:
-                    # Load and process original image
-                    img = cv2.imread(image_path)
-                    if img is None:
-                        print(f"  - Skipping corrupted file: {image_name}")
+                    # Detect faces in original image and keep the largest (main subject)
+                    crop = align_largest_face(app, img)
+                    if crop is None:
                         continue
-                        
-                    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                    # Detect faces in original image
-                    faces = app.get(img_rgb)
-                    if len(faces) > 0:
-                        # Use the largest face (main subject)
-                        face = max(faces, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))
-                        emb = face.normed_embedding
-                        person_embeddings.append(emb)
-                        embedding_vectors.append(emb)
-                        labels.append(student_folder)
-                        images_for_person += 1
-
-                    # Create augmented versions for better training
-                    num_augmentations = min(3, max(1, 5 - len(image_files)))  # Adaptive augmentation
-                    
-                    for aug_idx in range(num_augmentations):
-                        try:
-                            aug_img = augmenter.augment_image(img_rgb)
-                            faces_aug = app.get(aug_img)
-                            
-                            if len(faces_aug) > 0:
-                                face_aug = max(faces_aug, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))
-                                emb_aug = face_aug.normed_embedding
-                                person_embeddings.append(emb_aug)
-                                embedding_vectors.append(emb_aug)
-                                labels.append(student_folder)
-                                
-                        except Exception as e:
-                            print(f"  - Augmentation {aug_idx} failed: {e}")
-                            continue
+                    face_crops.append(crop)
+                    images_for_person += 1
 
                 except Exception as e:
                     print(f"  - Error processing {image_name}: {e}")
                     continue
 
             # Create representative embedding for the student
-            if person_embeddings:
-                # Use median embedding for robustness (less affected by outliers)
-                person_embeddings = np.array(person_embeddings)
-                
-                # Calculate median embedding
-                median_embedding = np.median(person_embeddings, axis=0)
-                median_embedding = median_embedding / np.linalg.norm(median_embedding)
-                
-                face_dict[student_folder.lower()] = median_embedding
+            if face_crops:
+                # Embed all of the student's aligned faces in batched recognition calls
+                person_embeddings = embed_faces(app, face_crops)
+
+                # Augmented versions for better training, made from the aligned crops so the
+                # detector runs once per photo instead of once per variant; students whose
+                # photos already vary enough get none
+                if (len(person_embeddings) >= DIVERSITY_MIN_FACES
+                        and embedding_diversity(person_embeddings) > DIVERSITY_THRESHOLD):
+                    num_augmentations = 0
+                if num_augmentations:
+                    aug_crops = augment_crops(face_crops, num_augmentations, rng, gpu_augmenter)
+                    if aug_crops:
+                        person_embeddings = np.concatenate([person_embeddings, embed_faces(app, aug_crops)])
+
+                all_emb[offsets[-1]:offsets[-1] + len(person_embeddings)] = person_embeddings
+                sample_labels[offsets[-1]:offsets[-1] + len(person_embeddings)] = len(student_labels)
+                offsets.append(offsets[-1] + len(person_embeddings))
+                student_labels.append(student_folder)
                 total_images_processed += images_for_person
                 
                 print(f"  - Successfully processed {images_for_person} images")
@@ -136,6 +173,16 @@ def main():
             else:
                 print(f"  - Warning: No faces detected for {student_folder}")
 
+        executor.shutdown()
+
+        embedding_vectors = all_emb[:offsets[-1]]
+        labels = sample_labels[:offsets[-1]]
+        if student_labels:
+            # Use median embedding for robustness (less affected by outliers)
+            medians = segment_medians(embedding_vectors, offsets)
+            normalize_rows(medians)
+            face_dict = dict(zip((name.lower() for name in student_labels), medians))
+
         # Validate training results
         if not face_dict:
             print("Error: No valid face embeddings generated!")
@@ -148,6 +195,13 @@ def main():
         with open(OUTPUT_FILE, "wb") as f:
             pickle.dump(face_dict, f)
 
+        # Also save the gallery as one contiguous (N, 512) float16 matrix that recognition can
+        # memory-map; half precision halves the file and costs well under 0.1% cosine accuracy
+        gallery_names = list(face_dict)
+        np.save(GALLERY_MATRIX_FILE, np.stack([face_dict[n] for n in gallery_names]).astype(np.float16))
+        with open(GALLERY_NAMES_FILE, "w") as f:
+            json.dump(gallery_names, f)
+
         print(f"\n Training Complete!")
         print(f"   - Students trained: {len(face_dict)}")
         print(f"   - Total images processed: {total_images_processed}")
@@ -156,8 +210,8 @@ def main():
 
         # Create visualization if sufficient data
         if len(embedding_vectors) >= 4:
-            create_enhanced_visualization(embedding_vectors, labels)
-            print(f"   - Training visualization saved to: '{VISUALIZATION_PATH}'")
+            if create_enhanced_visualization(embedding_vectors, labels, student_labels):
+                print(f"   - Training visualization saved to: '{VISUALIZATION_PATH}'")
 
         # Quality assessment
         assess_training_quality(face_dict, labels)
@@ -168,17 +222,247 @@ def main():
         traceback.print_exc()
         sys.exit(1)
 
-def create_enhanced_visualization(embedding_vectors, labels):
-    """Create comprehensive t-SNE visualization"""
+# select_providers/create_app are kept identical in recognize and train, which are deployed
+# as standalone scripts
+def select_providers():
+    """Execution providers for FACEFLOW_DEVICE, keeping only those this onnxruntime build has.
+
+    'auto' (the default) means CUDA on GPU builds of onnxruntime and plain CPU otherwise.
+    """
+    device = DEVICE
+    if device == "auto":
+        device = "cuda" if onnxruntime.get_device() == "GPU" else "cpu"
+    available = set(onnxruntime.get_available_providers())
+    providers = [p for p in DEVICE_PROVIDERS.get(device, DEVICE_PROVIDERS["cpu"])
+                 if (p[0] if isinstance(p, tuple) else p) in available]
+    return providers or ['CPUExecutionProvider']
+
+def create_app(det_size=DET_SIZE, intra_op_threads=1):
+    """Load detection + recognition on the selected providers with intra_op_threads ORT threads"""
+    providers = select_providers()
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_threads
+    with contextlib.redirect_stdout(sys.stderr):
+        # Load on CPU first: FaceAnalysis does not forward session options, so each session is
+        # rebuilt with them, and building GPU sessions twice would double engine setup
+        app = FaceAnalysis(name='buffalo_l', allowed_modules=MODEL_MODULES, providers=['CPUExecutionProvider'])
+        for model in app.models.values():
+            model.session = onnxruntime.InferenceSession(
+                model.model_file, sess_options=sess_options, providers=providers)
+        # ctx_id stays 0: a negative ctx_id makes InsightFace force the sessions back onto the CPU provider
+        app.prepare(ctx_id=0, det_size=(det_size, det_size))
+        if providers[0] != 'CPUExecutionProvider':
+            # Pay CUDA/TensorRT initialization before the first real image
+            app.get(np.zeros((det_size, det_size, 3), dtype=np.uint8))
+    return app
+
+def available_cpus():
+    """CPUs this process may run on, honouring affinity/cgroup cpusets unlike os.cpu_count()"""
     try:
-        embedding_vectors = np.array(embedding_vectors)
-        
-        # Standardize embeddings
-        scaler = StandardScaler()
-        embedding_vectors_scaled = scaler.fit_transform(embedding_vectors)
+        return len(os.sched_getaffinity(0))
+    except AttributeError:   # not available on Windows/macOS
+        return os.cpu_count() or 1
+
+def prefetch(executor, fn, items, depth):
+    """Yield fn(item) for each item in order, keeping up to `depth` calls running ahead"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def fast_augment(crop, rng):
+    """Enhanced augmentation for an aligned 112x112 face crop: one pass per step, skipping no-ops
+
+    There is no rotation step: re-detecting and aligning a rotated photo undid the rotation,
+    so it never reached the embedder.
+    """
+    out = cv2.flip(crop, 1) if rng.random() < 0.5 else crop  # Horizontal flip
+
+    # Brightness (x0.8-1.2) then gamma contrast (0.7-1.3), folded into one lookup table
+    brightness = rng.uniform(0.8, 1.2)
+    gamma = rng.uniform(0.7, 1.3)
+    lut = np.clip(np.arange(256) * (brightness / 255.0), 0.0, 1.0) ** gamma * 255.0
+    out = cv2.LUT(out, np.clip(lut + 0.5, 0, 255).astype(np.uint8))
+
+    # Noise: std up to 3% of full scale; below one grey level it would round away
+    noise_std = rng.uniform(0.0, 0.03 * 255)
+    if noise_std >= AUG_MIN_NOISE_STD:
+        noisy = out + rng.normal(0.0, noise_std, out.shape).astype(np.float32)
+        out = np.clip(noisy + 0.5, 0, 255).astype(np.uint8)
+
+    # Slight blur: a 3x3 kernel at small sigma is nearly the identity
+    blur_sigma = rng.uniform(0.1, 1.0)
+    if blur_sigma >= AUG_MIN_BLUR_SIGMA:
+        out = cv2.GaussianBlur(out, (3, 3), blur_sigma)
+    return out
+
+def build_gpu_augmenter():
+    """The fast_augment pipeline as batched Kornia modules on CUDA, or None without torch/kornia/GPU
+
+    Returns (flip + brightness + gamma, blur); augment_crops adds the noise in between, because
+    Kornia's noise uses one fixed std where fast_augment samples it per image.
+    """
+    # torch is imported here, and only on GPU builds of onnxruntime, so CPU training runs
+    # never pay its import time and memory even where it is installed
+    if onnxruntime.get_device() != "GPU":
+        return None
+    try:
+        import torch
+        import kornia.augmentation as K
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+    photometric = torch.nn.Sequential(
+        K.RandomHorizontalFlip(p=0.5),
+        K.ColorJitter(brightness=0.2, p=1.0),
+        K.RandomGamma(gamma=(0.7, 1.3), p=1.0),
+    ).cuda()
+    blur = K.RandomGaussianBlur((3, 3), (0.1, 1.0), p=1.0).cuda()
+    return photometric, blur
+
+def augment_crops(crops, num_augmentations, rng, gpu_augmenter=None):
+    """Return num_augmentations augmented copies of every aligned crop"""
+    if gpu_augmenter is not None:
+        import torch   # already loaded by build_gpu_augmenter
+        try:
+            # One upload and one kernel launch per step for all of the student's variants
+            batch = torch.from_numpy(np.repeat(np.stack(crops), num_augmentations, axis=0)).cuda()
+            photometric, blur = gpu_augmenter
+            with torch.no_grad():
+                out = photometric(batch.permute(0, 3, 1, 2).float().div_(255))
+                # Noise std drawn per image from [0, 3%] of full scale, skipped below
+                # AUG_MIN_NOISE_STD grey levels, as in fast_augment
+                noise_std = torch.empty((len(out), 1, 1, 1), device=out.device).uniform_(0.0, 0.03)
+                noise_std[noise_std < AUG_MIN_NOISE_STD / 255.0] = 0.0
+                out = blur((out + torch.randn_like(out) * noise_std).clamp_(0, 1))
+                out = out.clamp_(0, 1).mul_(255).round_().byte().permute(0, 2, 3, 1).contiguous()
+            return list(out.cpu().numpy())
+        except Exception as e:
+            print(f"  - GPU augmentation failed, using CPU: {e}")
+    augmented = []
+    for crop in crops:
+        for aug_idx in range(num_augmentations):
+            try:
+                augmented.append(fast_augment(crop, rng))
+            except Exception as e:
+                print(f"  - Augmentation {aug_idx} failed: {e}")
+    return augmented
+
+def load_training_image(image_path):
+    """Decode one photo; returns (img, error message), img is None if unreadable
+
+    Images stay BGR, the channel order InsightFace (and recognition) expects.
+    """
+    try:
+        img = cv2.imread(image_path)
+        if img is None:
+            return None, None
+        return img, None
+    except Exception as e:
+        return None, f"Error processing {os.path.basename(image_path)}: {e}"
+
+def align_largest_face(app, img):
+    """Detect faces and return the aligned 112x112 crop of the largest one, or None
+
+    None is also returned when even the largest face is under MIN_FACE_SIZE.
+    """
+    bboxes, kpss = app.det_model.detect(img, max_num=0, metric='default')
+    if len(bboxes) == 0:
+        return None
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    largest = int(areas.argmax())
+    if areas[largest] < MIN_FACE_SIZE * MIN_FACE_SIZE:
+        return None
+    rec_model = app.models['recognition']
+    return face_align.norm_crop(img, landmark=kpss[largest], image_size=rec_model.input_size[0])
+
+def embed_faces(app, crops):
+    """Embed aligned face crops with batched recognition calls; returns unit-norm rows (M, 512)"""
+    rec_model = app.models['recognition']
+    feats = np.concatenate([
+        rec_model.get_feat(crops[i:i + EMBED_BATCH_SIZE])
+        for i in range(0, len(crops), EMBED_BATCH_SIZE)
+    ]).astype(np.float32)
+    normalize_rows(feats)
+    return feats
+
+def embedding_diversity(emb):
+    """1 - mean pairwise cosine similarity of unit-norm rows (self-pairs included), one GEMM"""
+    return 1.0 - float((emb @ emb.T).mean())
+
+def _normalize_rows_numpy(emb):
+    """Scale each row of emb to unit length, in place"""
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+
+def _segment_medians_numpy(emb, offsets):
+    """Per-segment median of emb rows, segments delimited by offsets.
+
+    One np.median per segment: memory stays bounded by the largest segment, unlike padding
+    every segment to the longest one, and the per-student call overhead is negligible.
+    """
+    out = np.empty((len(offsets) - 1, emb.shape[1]), dtype=np.float32)
+    for s, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        out[s] = np.median(emb[start:end], axis=0)
+    return out
+
+if njit is not None:
+    # Compiled versions: one fused loop per row/column instead of several numpy passes,
+    # spread over cores with prange; cache=True keeps the compile cost to the first run
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normalize_rows_numba(emb):
+        for i in prange(emb.shape[0]):
+            total = 0.0
+            for j in range(emb.shape[1]):
+                total += emb[i, j] * emb[i, j]
+            inv = 1.0 / np.sqrt(total)
+            for j in range(emb.shape[1]):
+                emb[i, j] *= inv
+
+    @njit(parallel=True, cache=True)
+    def _segment_medians_numba(emb, offsets):
+        out = np.empty((len(offsets) - 1, emb.shape[1]), dtype=emb.dtype)
+        for s in prange(len(offsets) - 1):
+            for j in range(emb.shape[1]):
+                out[s, j] = np.median(emb[offsets[s]:offsets[s + 1], j])
+        return out
+
+    def normalize_rows(emb):
+        _normalize_rows_numba(emb)
+
+    def segment_medians(emb, offsets):
+        return _segment_medians_numba(emb, np.asarray(offsets, dtype=np.int64))
+else:
+    normalize_rows = _normalize_rows_numpy
+    segment_medians = _segment_medians_numpy
+
+def create_enhanced_visualization(embedding_vectors, labels, label_names):
+    """Create comprehensive t-SNE visualization; returns whether the plot was saved
+
+    labels holds one index into label_names per row of embedding_vectors.
+    """
+    try:
+        # Imported here so training that skips the plot never loads them; Agg needs no GUI toolkit
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from sklearn.decomposition import PCA
+        from sklearn.manifold import TSNE
+
+        embedding_vectors = np.asarray(embedding_vectors, dtype=np.float32)
+        labels = np.asarray(labels)
+
+        # Embeddings are already unit-norm, so no standardization: it would distort the
+        # angular geometry the cosine t-SNE relies on.
+        # Project onto the top principal components first; t-SNE cost scales with dimensionality
+        n_samples, n_dims = embedding_vectors.shape
+        pca = PCA(n_components=min(TSNE_PCA_COMPONENTS, n_samples - 1, n_dims), random_state=42)
+        embedding_vectors_reduced = pca.fit_transform(embedding_vectors)
 
         # Adjust perplexity based on data size
-        n_samples = len(embedding_vectors)
         perplexity = min(30, max(5, n_samples // 3))
         
         # Fit t-SNE with appropriate parameters
@@ -187,25 +471,33 @@ def create_enhanced_visualization(embedding_vectors, labels):
             perplexity=perplexity,
             learning_rate=200, 
             random_state=42, 
-            n_iter=1000,
-            metric='cosine'
+            max_iter=1000,
+            metric='cosine',
+            init='pca',
+            method='barnes_hut',
+            n_jobs=-1
         )
-        reduced_embeddings = tsne.fit_transform(embedding_vectors_scaled)
+        reduced_embeddings = tsne.fit_transform(embedding_vectors_reduced)
 
         # Create enhanced plot
         plt.figure(figsize=(14, 10))
         
         # Set style
         plt.style.use('seaborn-v0_8')
-        unique_labels = sorted(list(set(labels)))
-        colors = plt.cm.Set3(np.linspace(0, 1, len(unique_labels)))
+        order = sorted(range(len(label_names)), key=lambda i: label_names[i])
+        colors = plt.cm.Set3(np.linspace(0, 1, len(order)))
+
+        # Group row indices by label with one stable sort instead of one full comparison per label
+        by_label = np.argsort(labels, kind='stable')
+        groups = np.split(by_label, np.cumsum(np.bincount(labels, minlength=len(label_names)))[:-1])
         
         # Plot points with better styling
-        for i, label in enumerate(unique_labels):
-            mask = np.array([l == label for l in labels])
+        for i, label_idx in enumerate(order):
+            label = label_names[label_idx]
+            points = reduced_embeddings[groups[label_idx]]
             plt.scatter(
-                reduced_embeddings[mask, 0], 
-                reduced_embeddings[mask, 1],
+                points[:, 0], 
+                points[:, 1],
                 c=[colors[i]], 
                 label=label.title(),
                 s=80,
@@ -222,9 +514,11 @@ def create_enhanced_visualization(embedding_vectors, labels):
         plt.tight_layout()
         plt.savefig(VISUALIZATION_PATH, dpi=300, bbox_inches='tight')
         plt.close()
+        return True
         
     except Exception as e:
         print(f"Visualization creation failed: {e}")
+        return False
 
 def assess_training_quality(face_dict, labels):
     """Assess the quality of training data"""
@@ -235,16 +529,11 @@ def assess_training_quality(face_dict, labels):
         student_names = list(face_dict.keys())
         
         if len(student_names) >= 2:
-            # Calculate inter-student distances (should be high)
-            inter_distances = []
-            for i in range(len(student_names)):
-                for j in range(i+1, len(student_names)):
-                    emb1 = face_dict[student_names[i]]
-                    emb2 = face_dict[student_names[j]]
-                    distance = np.linalg.norm(emb1 - emb2)
-                    inter_distances.append(distance)
+            # Calculate inter-student distances (should be high), all pairs in one call
+            gallery = np.stack([face_dict[name] for name in student_names]).astype(np.float32)
+            inter_distances = pdist(gallery, metric='euclidean')
             
-            avg_inter_distance = np.mean(inter_distances)
+            avg_inter_distance = inter_distances.mean()
             print(f"   - Average inter-student distance: {avg_inter_distance:.3f}")
             
             if avg_inter_distance > 0.8:
@@ -257,13 +546,12 @@ def assess_training_quality(face_dict, labels):
                 print("   - Quality: POOR - Students are too similar, add more diverse photos")
 
         # Sample distribution
-        label_counts = {}
-        for label in labels:
-            label_counts[label] = label_counts.get(label, 0) + 1
+        label_counts = np.bincount(labels) if len(labels) else np.zeros(0, dtype=np.int64)
+        label_counts = label_counts[label_counts > 0]
         
-        min_samples = min(label_counts.values()) if label_counts else 0
-        max_samples = max(label_counts.values()) if label_counts else 0
-        avg_samples = sum(label_counts.values()) / len(label_counts) if label_counts else 0
+        min_samples = int(label_counts.min()) if len(label_counts) else 0
+        max_samples = int(label_counts.max()) if len(label_counts) else 0
+        avg_samples = float(label_counts.mean()) if len(label_counts) else 0
         
         print(f"   - Samples per student: {min_samples}-{max_samples} (avg: {avg_samples:.1f})")
         
@@ -286,14 +574,15 @@ def process_base64_image(base64_string, app):
         if base64_string.startswith('data:image'):
             base64_string = base64_string.split(',')[1]
         
-        image_data = base64.b64decode(base64_string)
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Convert to numpy array
-        img_array = np.array(image.convert('RGB'))
+        # Decode straight from the byte buffer with OpenCV
+        image_data = np.frombuffer(base64.b64decode(base64_string), dtype=np.uint8)
+        img_bgr = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
+        if img_bgr is None:
+            print("Error processing base64 image: could not decode image data")
+            return None
         
-        # Get face embeddings
-        faces = app.get(img_array)
+        # Get face embeddings (InsightFace takes BGR)
+        faces = app.get(img_bgr)
         if len(faces) > 0:
             # Return the largest face embedding
             largest_face = max(faces, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))